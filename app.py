@@ -1,20 +1,24 @@
 # app.py
-from flask import Flask, send_from_directory, jsonify
+from flask import Flask, send_from_directory, jsonify, g
 from flask_cors import CORS
+import orjson
 from flask_jwt_extended import JWTManager
 from flask_swagger_ui import get_swaggerui_blueprint
+from datetime import datetime, timezone
 from config import Config
 
 # Extensions
-from extensions import mongo
+from extensions import mongo, token_version_cache, token_version_lock, OrjsonProvider
 
 
+from models import ensure_indexes, migrate_message_chat_ids, parse_object_id
 from auth import auth_bp
 from chat import chat_bp
 
 
 def create_app():
     app = Flask(__name__)
+    app.json = OrjsonProvider(app)
     app.config.from_object(Config)
 
     # ---------- CORS: Allow all origins (dev) ----------
@@ -28,17 +32,52 @@ def create_app():
     )
 
     # ---------- Extensions ----------
-    mongo.init_app(app)
+    mongo.init_app(app, compressors=Config.MONGO_COMPRESSORS)
     jwt = JWTManager(app)
+    ensure_indexes()
 
-    # JWT Blacklist in MongoDB
+    # JWT revocation: tokens carry the user's token_version as "ver"
     app.config["JWT_BLACKLIST_ENABLED"] = True
     app.config["JWT_BLACKLIST_TOKEN_CHECKS"] = ["access"]
 
     @jwt.token_in_blocklist_loader
     def check_if_token_revoked(jwt_header, jwt_payload):
-        jti = jwt_payload["jti"]
-        return mongo.db.blacklist.find_one({"jti": jti}) is not None
+        user_id = jwt_payload["sub"]
+
+        # Tokens issued before token_version existed carry no "ver" claim;
+        # keep honouring the old jti blacklist for them. They all expire
+        # within JWT_ACCESS_TOKEN_EXPIRES of the deploy, after which this
+        # branch (and the blacklist collection) can go.
+        if "ver" not in jwt_payload:
+            try:
+                if mongo.db.blacklist.find_one({"jti": jwt_payload["jti"]}, {"_id": 1}):
+                    return True
+            except Exception:
+                return True
+
+        with token_version_lock:
+            current = token_version_cache.get(user_id)
+
+        if current is None:
+            user_oid = parse_object_id(user_id)
+            if user_oid is None:
+                return True
+            try:
+                user = mongo.db.users.find_one({"_id": user_oid}, {"token_version": 1})
+            except Exception:
+                return True
+            if not user:
+                return True
+            current = user.get("token_version", 0)
+            with token_version_lock:
+                token_version_cache[user_id] = current
+
+        return jwt_payload.get("ver", 0) != current
+
+    # One timestamp per request (see extensions.utc_now)
+    @app.before_request
+    def stamp_request_time():
+        g.now = datetime.now(timezone.utc)
 
     # ---------- Blueprints: NO /api prefix ----------
     app.register_blueprint(auth_bp)        # → /auth/login, /auth/register
@@ -63,6 +102,17 @@ def create_app():
     def serve_avatar(filename):
         return send_from_directory('static/avatars', filename)
 
+    # ---------- Malformed JSON bodies (see extensions.json_body) ----------
+    @app.errorhandler(orjson.JSONDecodeError)
+    def handle_invalid_json(e):
+        return jsonify({"error": "Invalid JSON body"}), 400
+
+    # ---------- One-off maintenance commands ----------
+    @app.cli.command("migrate-chat-ids")
+    def migrate_chat_ids_command():
+        """Convert legacy string messages.chat_id values to ObjectId."""
+        print(f"Converted {migrate_message_chat_ids()} messages")
+
     # ---------- Health check ----------
     @app.route('/')
     def home():
@@ -1,29 +1,29 @@
 # auth/routes.py
 from . import auth_bp
-from flask import request, jsonify, current_app
+from flask import request, jsonify, current_app, g
 from flask_jwt_extended import (
     create_access_token, jwt_required, get_jwt_identity,
     get_jwt, unset_jwt_cookies
 )
-from werkzeug.utils import secure_filename
-from bson import ObjectId
-from datetime import datetime
 import os
+import shutil
+import time
 import logging
 
 # Import shared mongo
-from extensions import mongo
+from extensions import mongo, token_version_cache, token_version_lock, json_body, utc_now
 
 # Import model functions
+from models import parse_object_id
 from models.users import (
-    create_user, verify_login_by_identifier,
-    get_user_by_identifier, update_profile
+    create_user, authenticate, update_profile, invalidate_user, USER_PUBLIC_FIELDS
 )
 
 # Avatar config
 UPLOAD_FOLDER = 'static/avatars'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+AVATAR_COPY_BUFFER = 1024 * 1024
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -32,8 +32,11 @@ def allowed_file(filename):
 def get_users():
     return mongo.db.users
 
-def get_blacklist():
-    return mongo.db.blacklist
+# Helper: current user's ObjectId, parsed once per request
+def current_user_oid():
+    if "_user_oid" not in g:
+        g._user_oid = parse_object_id(get_jwt_identity())
+    return g._user_oid
 
 # -------------------------------------------------
 # Setup Logging
@@ -46,69 +49,52 @@ logging.basicConfig(
 logger = logging.getLogger('auth')
 
 # -------------------------------------------------
-# Helper: Log request start
+# Request logging: one line per request, skipped below INFO
 # -------------------------------------------------
-def log_request_start():
-    client_ip = request.remote_addr
-    method = request.method
-    path = request.path
-    user_agent = request.headers.get('User-Agent', 'Unknown')
-    logger.info(f"REQUEST START → {method} {path} | IP: {client_ip} | UA: {user_agent}")
-
-# -------------------------------------------------
-# Helper: Log response
-# -------------------------------------------------
-def log_response(status_code, data=None, error=None):
-    method = request.method
-    path = request.path
-    log_msg = f"RESPONSE → {method} {path} | Status: {status_code}"
-    if error:
-        log_msg += f" | Error: {error}"
-    if data:
-        log_msg += f" | Data: {data}"
-    logger.info(log_msg)
+@auth_bp.before_request
+def start_request_timer():
+    g._t0 = time.perf_counter()
+
+@auth_bp.after_request
+def log_request(response):
+    if logger.isEnabledFor(logging.INFO):
+        elapsed_ms = (time.perf_counter() - g.get("_t0", time.perf_counter())) * 1000
+        logger.info(
+            "%s %s | Status: %s | %.1f ms | IP: %s",
+            request.method, request.path, response.status_code,
+            elapsed_ms, request.remote_addr
+        )
+    return response
 
 # -------------------------------------------------
 # 1. Register → POST /auth/register
 # -------------------------------------------------
 @auth_bp.route('/auth/register', methods=['POST'])
 def register():
-    log_request_start()
-    data = request.get_json(silent=True) or {}
+    data = json_body()
     username = data.get('username')
     email = data.get('email')
     password = data.get('password')
 
     if not all([username, email, password]):
         error = "All fields are required"
-        log_response(400, error=error)
         return jsonify({"error": error}), 400
 
     try:
         create_user(username, email, password)
-        log_response(201, data={"message": "User created successfully"})
         return jsonify({"message": "User created successfully"}), 201
     except ValueError as e:
         error = str(e)
-        log_response(400, error=error)
         return jsonify({"error": error}), 400
     except Exception as e:
-        error = f"Unexpected error: {str(e)}"
-        logger.error(error)
-        log_response(500, error=error)
+        logger.exception("Unexpected error: %s", e)
         return jsonify({"error": "Internal server error"}), 500
 
 
 # In auth/routes.py - Update the login route
 @auth_bp.route('/auth/login', methods=['POST'])
 def login():
-    log_request_start()
-    
-    data = request.get_json(force=True, silent=True)
-    if data is None:
-        data = {}
-    
-    logger.info(f"Login attempt - Received data: {data}")
+    data = json_body()
     
     # ACCEPT MULTIPLE FIELD NAME VARIATIONS
     identifier = (
@@ -119,30 +105,34 @@ def login():
     )
     password = data.get('password')
 
+    # Never log the body itself: it carries the plaintext password
+    logger.info("Login attempt - Identifier: %s, Password: %s", identifier, bool(password))
+
     if not identifier or not password:
         error = "Identifier and password are required"
-        logger.warning(f"Login failed - Missing fields. Identifier: {bool(identifier)}, Password: {bool(password)}")
-        log_response(400, error=error)
+        logger.warning(
+            "Login failed - Missing fields. Identifier: %s, Password: %s",
+            bool(identifier), bool(password)
+        )
         return jsonify({"error": error}), 400
 
     try:
-        if verify_login_by_identifier(identifier, password):
-            user = get_user_by_identifier(identifier)
-            token = create_access_token(identity=str(user["_id"]))
-            log_response(200, data={"message": "Login successful", "user_id": str(user["_id"])})
+        user = authenticate(identifier, password)
+        if user:
+            token = create_access_token(
+                identity=str(user["_id"]),
+                additional_claims={"ver": user.get("token_version", 0)}
+            )
             return jsonify({
                 "access_token": token,
                 "message": "Login successful"
             }), 200
 
         error = "Invalid credentials"
-        log_response(401, error=error)
         return jsonify({"error": error}), 401
         
     except Exception as e:
-        error = f"Login error: {str(e)}"
-        logger.error(error)
-        log_response(500, error=error)
+        logger.exception("Login error: %s", e)
         return jsonify({"error": "Internal server error"}), 500
 # -------------------------------------------------
 # 3. Logout → POST /auth/logout
@@ -150,28 +140,27 @@ def login():
 @auth_bp.route('/auth/logout', methods=['POST'])
 @jwt_required()
 def logout():
-    log_request_start()
     try:
-        jti = get_jwt()["jti"]
-        exp = get_jwt()["exp"]
-        user_id = get_jwt_identity()
+        claims = get_jwt()
+        user_id = claims["sub"]
 
-        get_blacklist().insert_one({
-            "jti": jti,
-            "expires_at": datetime.fromtimestamp(exp),
-            "revoked_at": datetime.utcnow(),
-            "user_id": user_id
-        })
+        # Bumping the version revokes every token issued before this point.
+        # Matching on the token's own version makes a replayed logout a no-op
+        # (None covers users created before token_version existed).
+        get_users().update_one(
+            {"_id": current_user_oid(), "token_version": {"$in": [claims.get("ver", 0), None]}},
+            {"$inc": {"token_version": 1}}
+        )
+        with token_version_lock:
+            token_version_cache.pop(user_id, None)
+        invalidate_user(user_id)
 
         response = jsonify({"message": "Logout successful"})
         unset_jwt_cookies(response)
-        log_response(200, data={"message": "Logout successful", "user_id": user_id})
         return response, 200
 
     except Exception as e:
-        error = f"Logout failed: {str(e)}"
-        logger.error(error)
-        log_response(500, error=error)
+        logger.exception("Logout failed: %s", e)
         return jsonify({"error": "Logout failed"}), 500
 
 
@@ -181,25 +170,21 @@ def logout():
 @auth_bp.route('/auth/profile', methods=['GET'])
 @jwt_required()
 def get_profile():
-    log_request_start()
     try:
-        user_id = get_jwt_identity()
-        user = get_users().find_one({"_id": ObjectId(user_id)})
+        user = get_users().find_one(
+            {"_id": current_user_oid()},
+            USER_PUBLIC_FIELDS
+        )
 
         if not user:
             error = "User not found"
-            log_response(404, error=error)
             return jsonify({"error": error}), 404
 
         user["_id"] = str(user["_id"])
-        user.pop("password_hash", None)
-        log_response(200, data={"user_id": user["_id"], "username": user.get("username")})
         return jsonify(user), 200
 
     except Exception as e:
-        error = f"Profile fetch failed: {str(e)}"
-        logger.error(error)
-        log_response(500, error=error)
+        logger.exception("Profile fetch failed: %s", e)
         return jsonify({"error": "Internal server error"}), 500
 
 
@@ -209,24 +194,19 @@ def get_profile():
 @auth_bp.route('/auth/profile', methods=['PUT'])
 @jwt_required()
 def edit_profile():
-    log_request_start()
     user_id = get_jwt_identity()
-    data = request.get_json(silent=True) or {}
+    data = json_body()
     username = data.get("username")
     email = data.get("email")
 
     try:
         update_profile(user_id, username=username, email=email)
-        log_response(200, data={"message": "Profile updated", "user_id": user_id})
         return jsonify({"message": "Profile updated successfully"}), 200
     except ValueError as e:
         error = str(e)
-        log_response(400, error=error)
         return jsonify({"error": error}), 400
     except Exception as e:
-        error = f"Profile update failed: {str(e)}"
-        logger.error(error)
-        log_response(500, error=error)
+        logger.exception("Profile update failed: %s", e)
         return jsonify({"error": "Internal server error"}), 500
 
 
@@ -236,36 +216,47 @@ def edit_profile():
 @auth_bp.route('/auth/profile/avatar', methods=['POST'])
 @jwt_required()
 def upload_avatar():
-    log_request_start()
     user_id = get_jwt_identity()
 
+    # Reject oversized bodies before the multipart parser touches them
+    max_length = current_app.config.get("MAX_CONTENT_LENGTH")
+    if max_length and request.content_length and request.content_length > max_length:
+        error = "File too large"
+        return jsonify({"error": error}), 413
+
     if 'avatar' not in request.files:
         error = "No file part"
-        log_response(400, error=error)
         return jsonify({"error": error}), 400
 
     file = request.files['avatar']
     if file.filename == '' or not allowed_file(file.filename):
         error = "Invalid file"
-        log_response(400, error=error)
         return jsonify({"error": error}), 400
 
     try:
-        filename = secure_filename(f"{user_id}_{file.filename}")
+        # Extension is whitelisted and user_id comes from the signed token,
+        # so no sanitising is needed; re-uploads overwrite the old avatar.
+        ext = file.filename.rsplit('.', 1)[1].lower()
+        filename = f"{user_id}.{ext}"
         filepath = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(filepath)
+        # An avatar uploaded under another extension would otherwise linger
+        for other in ALLOWED_EXTENSIONS - {ext}:
+            try:
+                os.remove(os.path.join(UPLOAD_FOLDER, f"{user_id}.{other}"))
+            except FileNotFoundError:
+                pass
+        with open(filepath, "wb", buffering=AVATAR_COPY_BUFFER) as out:
+            shutil.copyfileobj(file.stream, out, length=AVATAR_COPY_BUFFER)
 
         avatar_url = f"/static/avatars/{filename}"
         get_users().update_one(
-            {"_id": ObjectId(user_id)},
-            {"$set": {"avatar_url": avatar_url, "updated_at": datetime.utcnow()}}
+            {"_id": current_user_oid()},
+            {"$set": {"avatar_url": avatar_url, "updated_at": utc_now()}}
         )
+        invalidate_user(user_id)
 
-        log_response(200, data={"avatar_url": avatar_url, "user_id": user_id})
         return jsonify({"avatar_url": avatar_url}), 200
 
     except Exception as e:
-        error = f"Avatar upload failed: {str(e)}"
-        logger.error(error)
-        log_response(500, error=error)
+        logger.exception("Avatar upload failed: %s", e)
         return jsonify({"error": "Upload failed"}), 500
\ No newline at end of file
@@ -1,74 +1,141 @@
 # routes/chats.py
-from flask import request, jsonify, Response, stream_with_context
+from flask import jsonify, Response
 from flask_jwt_extended import jwt_required, get_jwt_identity
+import httpx
 from openai import OpenAI, APIError, AuthenticationError, RateLimitError
 from config import Config
+from extensions import json_body, json_array_stream
 from . import chat_bp
-from models.chat import create_chat, get_user_chats, get_chat, delete_chat, update_chat_title as db_update_title
-from models.message import add_message, get_history, get_messages, update_message_content
-import json
+from models.chat import (
+    create_chat, get_user_chats, get_chat, delete_chat,
+    update_chat_title as db_update_title, update_message_role_content
+)
+from models.message import (
+    add_message, get_history, iter_messages, update_message_content, delete_messages,
+    set_message_sources
+)
+import logging
+import orjson
 import re
+import time
 import uuid
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from threading import Lock
 from bson import ObjectId
+from cachetools import TTLCache
+
+# Active streams by stream_id; the TTL reaps entries whose stream died
+# without cleaning up. All access goes through streams_lock.
+active_streams = TTLCache(maxsize=10000, ttl=600)
+streams_lock = Lock()
+
+logger = logging.getLogger(__name__)
+
+# Fire-and-forget DB jobs the response never waits on (source extraction,
+# delete cascades); submit via run_in_background
+BACKGROUND = ThreadPoolExecutor(max_workers=4)
 
-# Global dictionary to store active streams
-active_streams = {}
+# DB writes that overlap a DeepSeek call; the reply write waits on them
+EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+# Fire-and-forget DeepSeek calls (auto titles), which can take minutes;
+# kept apart so they never queue DB jobs behind them
+LLM_JOBS = ThreadPoolExecutor(max_workers=4)
+
+
+def run_in_background(fn, *args, pool=BACKGROUND):
+    """Submit a job to a pool; the caller may never wait on its Future, so failures are logged"""
+    def log_failure(future):
+        try:
+            future.result()
+        except Exception:
+            # args[0] is a chat or message id for every job; the rest may be message text
+            logger.exception("Background job %s failed (%s)", fn.__name__, args[0])
+
+    future = pool.submit(fn, *args)
+    future.add_done_callback(log_failure)
+    return future
 
 # ----------------------------------------------------------------------
 # DeepSeek client with increased timeout
 # ----------------------------------------------------------------------
+# Pooled HTTP/2 transport shared by every request so concurrent chats
+# multiplex over kept-alive connections instead of re-handshaking TLS
+http_client = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    timeout=httpx.Timeout(120.0, connect=10.0)
+)
+
 client = OpenAI(
     api_key=Config.DEEPSEEK_API_KEY,
     base_url=Config.DEEPSEEK_BASE_URL,
-    timeout=120,
-    max_retries=3
+    max_retries=1,  # bounds a dead upstream at 2 × 120s per call
+    http_client=http_client
 )
 
 MODEL = "deepseek-chat"
 
-def extract_sources_from_response(content):
-    """Extract potential sources and links from AI response"""
-    sources = []
-    
-    # Look for markdown links [text](url)
-    link_pattern = r'\[([^\]]+)\]\(([^)]+)\)'
-    links = re.findall(link_pattern, content)
-    
-    for text, url in links:
-        if url.startswith(('http://', 'https://')):
-            sources.append({
-                "title": text,
-                "url": url,
-                "type": "website"
-            })
-    
-    # Look for standalone URLs
-    url_pattern = r'https?://[^\s\)]+'
-    urls = re.findall(url_pattern, content)
-    for url in urls:
-        if url not in [s['url'] for s in sources]:
-            sources.append({
-                "title": "Related Resource",
-                "url": url,
-                "type": "website"
-            })
-    
-    # Look for citations [1], [2], etc.
-    citation_pattern = r'\[\d+\]'
-    if re.search(citation_pattern, content):
-        sources.append({
-            "title": "Academic References",
-            "url": "#citations",
-            "type": "citation"
-        })
-    
-    return sources
+# Source extraction: markdown link [text](http...) or a bare URL, one scan
+_SOURCE_RE = re.compile(
+    r'\[(?P<text>[^\]]+)\]\((?P<link>https?://[^)]+)\)'
+    r'|(?P<bare>https?://[^\s\)\]]+)'
+)
+
+# Source categories by URL, in priority order
+_CATEGORY_RE = re.compile(
+    r'(?P<documentation>docs\.|documentation|developer\.|api\.)'
+    r'|(?P<code_repository>github\.com|gitlab\.com|bitbucket\.org)'
+    r'|(?P<discussion>stackoverflow\.com|stackexchange\.com|reddit\.com)'
+    r'|(?P<encyclopedia>wikipedia\.org|britannica\.com)'
+    r'|(?P<academic>arxiv\.org|researchgate\.net|scholar\.google)'
+    r'|(?P<tutorial>medium\.com|dev\.to|tutorial|guide)'
+    r'|(?P<news>news\.|reuters\.com|bbc\.com|cnn\.com)',
+    re.IGNORECASE
+)
+_CATEGORY_PRIORITY = _CATEGORY_RE.groupindex
+_ACADEMIC_TITLE_RE = re.compile(r'paper|research|study|journal', re.IGNORECASE)
+
+# Sliding context window sent to DeepSeek (~4 chars per token → ~6k tokens)
+MAX_TURNS = 20
+MAX_HISTORY_CHARS = 24000
+
+# SSE batching: flush once this many characters are buffered, on a newline,
+# or once this many seconds have passed since the last frame
+SSE_FLUSH_CHARS = 64
+SSE_FLUSH_INTERVAL = 0.05
+
+# Static system prompts, shared across requests (treat as read-only)
+SYSTEM_PROMPT = {
+    "role": "system",
+    "content": "You are a helpful assistant. Provide comprehensive responses with relevant sources and links when appropriate."
+}
+CONTINUE_SYSTEM_PROMPT = {
+    "role": "system",
+    "content": "You are a helpful assistant. Continue the response naturally from where it was left off. Maintain the exact same style, tone, and level of detail. Continue providing helpful information with sources where appropriate."
+}
+
+def recent_history(history):
+    """Clip history to the last MAX_TURNS messages within MAX_HISTORY_CHARS.
+    The newest message is always kept."""
+    end = len(history)
+    start = max(0, end - MAX_TURNS)
+    total = sum(len(history[i]["content"]) for i in range(start, end))
+    while total > MAX_HISTORY_CHARS and start < end - 1:
+        total -= len(history[start]["content"])
+        start += 1
+    return history[start:] if start else history
+
+def sse_event(payload):
+    """Encode a payload as a single SSE `data:` frame (bytes)."""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
 # routes/chats.py - Update the system message for better source generation
-def get_enhanced_system_message():
-    return {
-        "role": "system", 
-        "content": """You are a helpful AI assistant that provides comprehensive, well-researched responses. 
+# Built once at import; shared read-only by every request
+ENHANCED_SYSTEM_PROMPT = {
+    "role": "system",
+    "content": """You are a helpful AI assistant that provides comprehensive, well-researched responses. 
 
 CRITICAL: For EVERY response, you MUST include relevant sources, references, and links to help users explore topics further. 
 
@@ -96,14 +163,17 @@ EXAMPLE SOURCE SECTION:
 - [GitHub Repository](https://github.com)
 
 Always provide comprehensive information with proper sources to help users learn and verify information."""
-    }
+}
+
+def get_enhanced_system_message():
+    return ENHANCED_SYSTEM_PROMPT
 
 # Update the send_message function - replace the system_message creation
 @chat_bp.route('/api/chats/<chat_id>/messages', methods=['POST'])
 @jwt_required()
 def send_message(chat_id):
     user_id = get_jwt_identity()
-    payload = request.get_json(silent=True) or {}
+    payload = json_body()
     content = payload.get('content')
     use_streaming = payload.get('stream', True)
     stream_id = payload.get('stream_id')
@@ -111,96 +181,120 @@ def send_message(chat_id):
     if not content:
         return jsonify({"error": "Field `content` is required"}), 400
 
-    chat = get_chat(chat_id, user_id)
-    if not chat:
+    # Read prior turns (None → chat missing or not owned) and append the user
+    # message locally
+    found = get_history(chat_id, user_id)
+    if found is None:
         return jsonify({"error": "Chat not found or not owned by you"}), 404
-
-    # Add user message
-    add_message(chat_id, "user", content)
-    history = get_history(chat_id)
+    history, message_count = found
+    first_turn = message_count == 0
+    history.append({"role": "user", "content": content})
+    context = recent_history(history)
 
     prompt_length = len(content)
     max_tokens = 2000 if prompt_length > 500 else 1500
 
     try:
+        # The user turn is written while DeepSeek generates the reply; it is
+        # kept even if the call fails, and the reply write waits on it so the
+        # two are stored in order
+        user_write = run_in_background(add_message, chat_id, user_id, "user", content, pool=EXECUTOR)
+
         if use_streaming:
             if not stream_id:
                 stream_id = str(uuid.uuid4())
             
             def generate():
+                reply = None  # full or partial (stopped) reply; stays None on errors
+                stored = False
+                full_parts = []
+
+                # Store stream state; the loop keeps its own reference, so
+                # stop_stream flipping "active" is seen even after it
+                # removes the entry from active_streams
+                state = {
+                    "chat_id": chat_id,
+                    "user_id": user_id,
+                    "content_parts": full_parts,  # shared list, joined on demand
+                    "active": True,
+                    "created_at": datetime.now(timezone.utc)
+                }
                 try:
-                    full_reply = ""
                     stream_buffer = []
-                    sources = []
-                    
-                    # Store stream state
-                    active_streams[stream_id] = {
-                        "chat_id": chat_id,
-                        "user_id": user_id,
-                        "content": full_reply,
-                        "active": True,
-                        "created_at": datetime.utcnow()
-                    }
+                    buffered_chars = 0
+                    last_flush = time.monotonic()
                     
-                    # Use enhanced system message
-                    system_message = get_enhanced_system_message()
+                    with streams_lock:
+                        active_streams[stream_id] = state
                     
                     stream = client.chat.completions.create(
                         model=MODEL,
-                        messages=[system_message] + history,
+                        messages=[ENHANCED_SYSTEM_PROMPT, *context],
                         max_tokens=max_tokens,
                         temperature=0.7,
                         stream=True
                     )
                     
                     for chunk in stream:
-                        if not active_streams.get(stream_id, {}).get("active", True):
-                            yield f"data: {json.dumps({'stopped': True, 'stream_id': stream_id, 'content_so_far': full_reply})}\n\n"
+                        if not state["active"]:
+                            reply = ''.join(full_parts)
+                            yield sse_event({'stopped': True, 'stream_id': stream_id, 'content_so_far': reply})
                             break
                             
                         if chunk.choices[0].delta.content:
                             content_piece = chunk.choices[0].delta.content
-                            full_reply += content_piece
+                            full_parts.append(content_piece)
                             stream_buffer.append(content_piece)
+                            buffered_chars += len(content_piece)
                             
-                            # Send chunks more frequently for smoother scrolling
-                            if len(stream_buffer) >= 2 or len(content_piece) > 30:
-                                yield f"data: {json.dumps({'content': ''.join(stream_buffer), 'stream_id': stream_id})}\n\n"
+                            # Batch deltas into fewer, larger SSE frames; flush on
+                            # size, on a line break (keeps prose snappy) or on time
+                            if (buffered_chars >= SSE_FLUSH_CHARS or '\n' in content_piece
+                                    or time.monotonic() - last_flush >= SSE_FLUSH_INTERVAL):
+                                yield sse_event({'content': ''.join(stream_buffer), 'stream_id': stream_id})
                                 stream_buffer = []
-                            
-                            # Update active stream
-                            if stream_id in active_streams:
-                                active_streams[stream_id]["content"] = full_reply
+                                buffered_chars = 0
+                                last_flush = time.monotonic()
                     
                     # Send remaining buffer
-                    if stream_buffer and active_streams.get(stream_id, {}).get("active", True):
-                        yield f"data: {json.dumps({'content': ''.join(stream_buffer), 'stream_id': stream_id})}\n\n"
+                    if stream_buffer and state["active"]:
+                        yield sse_event({'content': ''.join(stream_buffer), 'stream_id': stream_id})
                     
-                    if active_streams.get(stream_id, {}).get("active", True):
-                        # Extract sources from final content
-                        sources = extract_sources_from_response(full_reply)
-                        
+                    if state["active"]:
+                        reply = ''.join(full_parts)
+
                         # Auto-generate chat title from first message if it's a new chat
-                        if len(history) == 1:  # Only user message + this will be first assistant response
-                            auto_title = generate_chat_title(content)
-                            if auto_title:
-                                update_chat_title(chat_id, auto_title)
+                        if first_turn:
+                            run_in_background(auto_title_chat, chat_id, user_id, content, pool=LLM_JOBS)
                         
-                        add_message(chat_id, "assistant", full_reply, sources)
-                        yield f"data: {json.dumps({'done': True, 'full_content': full_reply, 'sources': sources, 'stream_id': stream_id})}\n\n"
-                    
-                    # Clean up
-                    if stream_id in active_streams:
-                        del active_streams[stream_id]
+                        # Stored before the done frame so the client's next message
+                        # sees (and sorts after) this turn; only source extraction
+                        # is deferred, and sources show up on the next fetch
+                        stored = True
+                        store_reply(chat_id, user_id, reply, user_write)
+                        yield sse_event({'done': True, 'full_content': reply, 'sources': [], 'stream_id': stream_id})
                         
                 except Exception as e:
-                    if stream_id in active_streams:
-                        del active_streams[stream_id]
-                    yield f"data: {json.dumps({'error': str(e)})}\n\n"
-
+                    yield sse_event({'error': str(e)})
+                finally:
+                    # Also runs when the client disconnects mid-stream; stores a
+                    # partial reply (on stop) that the success path didn't
+                    with streams_lock:
+                        active_streams.pop(stream_id, None)
+                    # Stopped but the loop never saw it (stop after the last
+                    # delta, or the client aborted right after /stop): /stop has
+                    # already returned this text, so it must be stored too
+                    if reply is None and not state["active"]:
+                        reply = ''.join(full_parts)
+                    if not stored and reply and reply.strip():
+                        store_reply(chat_id, user_id, reply, user_write)
+
+            # Everything generate() needs is bound in its closure, so it runs
+            # without pushing the request context on every chunk
             return Response(
-                stream_with_context(generate()),
+                generate(),
                 mimetype='text/event-stream',
+                direct_passthrough=True,
                 headers={
                     'Cache-Control': 'no-cache', 
                     'X-Accel-Buffering': 'no',
@@ -210,11 +304,9 @@ def send_message(chat_id):
             )
         else:
             # Non-streaming response
-            system_message = get_enhanced_system_message()
-            
             completion = client.chat.completions.create(
                 model=MODEL,
-                messages=[system_message] + history,
+                messages=[ENHANCED_SYSTEM_PROMPT, *context],
                 max_tokens=max_tokens,
                 temperature=0.7,
                 stream=False
@@ -223,12 +315,11 @@ def send_message(chat_id):
             sources = extract_sources_from_response(reply)
             
             # Auto-generate chat title for new chats
-            if len(history) == 1:
-                auto_title = generate_chat_title(content)
-                if auto_title:
-                    update_chat_title(chat_id, auto_title)
+            if first_turn:
+                run_in_background(auto_title_chat, chat_id, user_id, content, pool=LLM_JOBS)
             
-            add_message(chat_id, "assistant", reply, sources)
+            user_write.result()
+            add_message(chat_id, user_id, "assistant", reply, sources)
             return jsonify({"content": reply, "sources": sources}), 200
 
     except Exception as e:
@@ -265,70 +356,65 @@ def generate_chat_title(first_message):
         print(f"Title generation failed: {e}")
         return None
 
+def auto_title_chat(chat_id, user_id, first_message):
+    """Background job: title a new chat from its first message"""
+    auto_title = generate_chat_title(first_message)
+    if auto_title:
+        db_update_title(chat_id, user_id, auto_title)
+
+def store_reply(chat_id, user_id, reply, user_write):
+    """Store a streamed (possibly partial) reply after its user turn; sources are added in the background"""
+    user_write.result()
+    doc = add_message(chat_id, user_id, "assistant", reply)
+    if doc and 'http' in reply:
+        run_in_background(store_sources, doc["_id"], reply)
+
+def store_sources(message_id, reply):
+    """Background job: attach the sources found in a stored reply"""
+    sources = extract_sources_from_response(reply)
+    if sources:
+        set_message_sources(message_id, sources)
+
 # Enhanced source extraction
 def extract_sources_from_response(content):
     """Extract potential sources and links from AI response with better detection"""
+    # Both link forms need "http"; most short replies have none, so skip the regex
+    if 'http' not in content:
+        return []
+
     sources = []
+    index_by_url = {}
     
-    # Look for markdown links [text](url)
-    link_pattern = r'\[([^\]]+)\]\(([^)]+)\)'
-    links = re.findall(link_pattern, content)
-    
-    for text, url in links:
-        if url.startswith(('http://', 'https://')):
-            # Categorize the source type
-            source_type = categorize_source(url, text)
-            sources.append({
-                "title": text,
-                "url": url,
-                "type": source_type
-            })
-    
-    # Look for standalone URLs
-    url_pattern = r'https?://[^\s\)\]]+'
-    urls = re.findall(url_pattern, content)
-    for url in urls:
-        if url not in [s['url'] for s in sources]:
-            source_type = categorize_source(url, "Related Resource")
+    # Single pass over markdown links [text](url) and standalone URLs
+    for m in _SOURCE_RE.finditer(content):
+        if m.lastgroup == "link":
+            url, title = m.group("link"), m.group("text")
+        else:
+            url, title = m.group("bare"), "Related Resource"
+
+        if url not in index_by_url:
+            index_by_url[url] = len(sources)
             sources.append({
-                "title": "Related Resource",
+                "title": title,
                 "url": url,
-                "type": source_type
+                "type": categorize_source(url, title)
             })
+        elif m.lastgroup == "link" and sources[index_by_url[url]]["title"] == "Related Resource":
+            # A labelled link beats an earlier bare mention of the same URL
+            sources[index_by_url[url]].update(title=title, type=categorize_source(url, title))
     
-    # Remove duplicates
-    unique_sources = []
-    seen_urls = set()
-    for source in sources:
-        if source['url'] not in seen_urls:
-            unique_sources.append(source)
-            seen_urls.add(source['url'])
-    
-    return unique_sources
+    return sources
 
 def categorize_source(url, title):
     """Categorize the source type based on URL and title"""
-    url_lower = url.lower()
-    title_lower = title.lower()
-    
-    if any(domain in url_lower for domain in ['docs.', 'documentation', 'developer.', 'api.']):
-        return "documentation"
-    elif any(domain in url_lower for domain in ['github.com', 'gitlab.com', 'bitbucket.org']):
-        return "code_repository"
-    elif any(domain in url_lower for domain in ['stackoverflow.com', 'stackexchange.com', 'reddit.com']):
-        return "discussion"
-    elif any(domain in url_lower for domain in ['wikipedia.org', 'britannica.com']):
-        return "encyclopedia"
-    elif any(domain in url_lower for domain in ['arxiv.org', 'researchgate.net', 'scholar.google']):
+    # One scan over the URL; if several categories match, the earlier
+    # group in _CATEGORY_RE wins (same priority as the old if/elif chain)
+    matched = {m.lastgroup for m in _CATEGORY_RE.finditer(url)}
+    if matched:
+        return min(matched, key=_CATEGORY_PRIORITY.__getitem__)
+    if _ACADEMIC_TITLE_RE.search(title):
         return "academic"
-    elif any(domain in url_lower for domain in ['medium.com', 'dev.to', 'tutorial', 'guide']):
-        return "tutorial"
-    elif any(domain in url_lower for domain in ['news.', 'reuters.com', 'bbc.com', 'cnn.com']):
-        return "news"
-    elif any(word in title_lower for word in ['paper', 'research', 'study', 'journal']):
-        return "academic"
-    else:
-        return "website"
+    return "website"
 
         
 # ----------------------------------------------------------------------
@@ -338,26 +424,28 @@ def categorize_source(url, title):
 @jwt_required()
 def stop_stream(chat_id):
     user_id = get_jwt_identity()
-    payload = request.get_json(silent=True) or {}
+    payload = json_body()
     stream_id = payload.get('stream_id')
     
     if not stream_id:
         return jsonify({"error": "stream_id is required"}), 400
     
-    if stream_id in active_streams:
-        if active_streams[stream_id]["user_id"] == user_id and active_streams[stream_id]["chat_id"] == chat_id:
-            active_streams[stream_id]["active"] = False
-            content_so_far = active_streams[stream_id]["content"]
-            
-            # Save the partial response
-            if content_so_far.strip():
-                sources = extract_sources_from_response(content_so_far)
-                add_message(chat_id, "assistant", content_so_far, sources)
-            
+    # Claim the stream atomically so only one stop request wins
+    with streams_lock:
+        state = active_streams.get(stream_id)
+        if state is None or state["user_id"] != user_id or state["chat_id"] != chat_id:
+            state = None
+        else:
             del active_streams[stream_id]
-            return jsonify({"stopped": True, "content_so_far": content_so_far}), 200
+
+    if state is None:
+        return jsonify({"error": "Stream not found or already stopped"}), 404
+
+    # The stream's generator stores the partial reply once it sees the flag
+    state["active"] = False
+    content_so_far = ''.join(state["content_parts"])
     
-    return jsonify({"error": "Stream not found or already stopped"}), 404
+    return jsonify({"stopped": True, "content_so_far": content_so_far}), 200
 
 # ----------------------------------------------------------------------
 # CONTINUE STREAM ENDPOINT - FIXED
@@ -366,34 +454,29 @@ def stop_stream(chat_id):
 @jwt_required()
 def continue_stream(chat_id):
     user_id = get_jwt_identity()
-    payload = request.get_json(silent=True) or {}
+    payload = json_body()
     previous_content = payload.get('previous_content', '')
     
     if not previous_content:
         return jsonify({"error": "previous_content is required"}), 400
 
-    chat = get_chat(chat_id, user_id)
-    if not chat:
-        return jsonify({"error": "Chat not found or not owned by you"}), 404
-
     # Get history (excluding the last partial message we're continuing from)
-    history = get_history(chat_id)
+    found = get_history(chat_id, user_id)
+    if found is None:
+        return jsonify({"error": "Chat not found or not owned by you"}), 404
+    history, _ = found
     
     # Remove the last assistant message if it's the one we're continuing
     if history and history[-1]["role"] == "assistant":
-        history = history[:-1]
+        history.pop()
+    history = recent_history(history)
     
     continue_prompt = f"Continue this response exactly from where it left off. Maintain the same style, tone, and depth. Here's what was written so far: {previous_content}"
     
     try:
-        system_message = {
-            "role": "system", 
-            "content": "You are a helpful assistant. Continue the response naturally from where it was left off. Maintain the exact same style, tone, and level of detail. Continue providing helpful information with sources where appropriate."
-        }
-        
         completion = client.chat.completions.create(
             model=MODEL,
-            messages=[system_message] + history + [{"role": "user", "content": continue_prompt}],
+            messages=[CONTINUE_SYSTEM_PROMPT, *history, {"role": "user", "content": continue_prompt}],
             max_tokens=1500,
             temperature=0.7,
             stream=False
@@ -406,7 +489,7 @@ def continue_stream(chat_id):
         
         # Add as a new message instead of updating the existing one
         # This keeps the conversation history cleaner
-        add_message(chat_id, "assistant", full_content, sources)
+        add_message(chat_id, user_id, "assistant", full_content, sources)
         
         return jsonify({
             "continued_content": continued_reply,
@@ -424,7 +507,7 @@ def continue_stream(chat_id):
 @jwt_required()
 def new_chat():
     user_id = get_jwt_identity()
-    data = request.get_json() or {}
+    data = json_body()
     title = data.get('title', 'New Chat')
     initial_message = data.get('message')
     
@@ -432,27 +515,23 @@ def new_chat():
     chat_id = chat["_id"]
     
     if initial_message:
-        add_message(chat_id, "user", initial_message)
-        history = get_history(chat_id)
+        # A brand-new chat has no prior turns, so no history read is needed
+        add_message(chat_id, user_id, "user", initial_message)
+        history = [{"role": "user", "content": initial_message}]
         prompt_length = len(initial_message)
         max_tokens = 2000 if prompt_length > 500 else 1500
         
         try:
-            system_message = {
-                "role": "system", 
-                "content": "You are a helpful assistant. Provide comprehensive responses with relevant sources and links when appropriate."
-            }
-            
             completion = client.chat.completions.create(
                 model=MODEL,
-                messages=[system_message] + history,
+                messages=[SYSTEM_PROMPT, *history],
                 max_tokens=max_tokens,
                 temperature=0.7,
                 stream=False
             )
             reply = completion.choices[0].message.content.strip()
             sources = extract_sources_from_response(reply)
-            add_message(chat_id, "assistant", reply, sources)
+            add_message(chat_id, user_id, "assistant", reply, sources)
             return jsonify({
                 "id": chat_id,
                 "title": title,
@@ -475,18 +554,14 @@ def new_chat():
 @jwt_required()
 def update_chat_title(chat_id):
     user_id = get_jwt_identity()
-    data = request.get_json() or {}
+    data = json_body()
     new_title = data.get('title')
     if not new_title:
         return jsonify({"error": "Field `title` is required"}), 400
 
-    chat = get_chat(chat_id, user_id)
-    if not chat:
+    if not db_update_title(chat_id, user_id, new_title):
         return jsonify({"error": "Chat not found or not owned by you"}), 404
 
-    if not db_update_title(chat_id, new_title):
-        return jsonify({"error": "Failed to update title"}), 500
-
     return jsonify({"title": new_title}), 200
 
 # ----------------------------------------------------------------------
@@ -504,7 +579,12 @@ def list_messages(chat_id):
     user_id = get_jwt_identity()
     if not get_chat(chat_id, user_id):
         return jsonify({"error": "Chat not found or not owned by you"}), 404
-    return jsonify(get_messages(chat_id))
+    # Streamed straight from the cursor rather than built as one list
+    return Response(
+        json_array_stream(iter_messages(chat_id)),
+        mimetype='application/json',
+        direct_passthrough=True
+    )
 
 @chat_bp.route('/api/chats/<chat_id>', methods=['DELETE'])
 @jwt_required()
@@ -512,13 +592,15 @@ def delete_chat_endpoint(chat_id):
     user_id = get_jwt_identity()
     if not delete_chat(chat_id, user_id):
         return jsonify({"error": "Chat not found or not owned by you"}), 404
+    # Cascade off the response path; the messages are unreachable without the chat
+    run_in_background(delete_messages, chat_id)
     return jsonify({"message": "Chat deleted"}), 200
 
 @chat_bp.route('/api/chats/<chat_id>/messages/<message_id>', methods=['PATCH'])
 @jwt_required()
 def edit_message(chat_id, message_id):
     user_id = get_jwt_identity()
-    payload = request.get_json(silent=True) or {}
+    payload = json_body()
     content = payload.get('content')
     role = payload.get('role')
     
@@ -1,4 +1,85 @@
 # extensions.py   (same folder as app.py)
+from datetime import datetime, timezone
+from decimal import Decimal
+from threading import Lock
+import orjson
+from bson import ObjectId
+from cachetools import TTLCache
+from flask import request, g, has_request_context
+from flask.json.provider import JSONProvider
 from flask_pymongo import PyMongo
 
-mongo = PyMongo()          # <-- only MongoDB
\ No newline at end of file
+mongo = PyMongo()          # <-- only MongoDB
+
+# In-process cache of users.token_version (keyed by user_id) for JWT revocation
+token_version_cache = TTLCache(maxsize=10000, ttl=30)
+token_version_lock = Lock()
+
+
+def utc_now():
+    """
+    Timezone-aware UTC timestamp. Inside a request this is the single
+    g.now stamped in before_request; elsewhere (background threads,
+    streaming generators) it is read fresh.
+    """
+    if has_request_context() and "now" in g:
+        return g.now
+    return datetime.now(timezone.utc)
+
+
+def _orjson_default(o):
+    # Types orjson can't encode itself; dates/datetimes are native (below)
+    if isinstance(o, ObjectId):
+        return str(o)
+    if isinstance(o, Decimal):
+        return str(o)
+    if hasattr(o, "__html__"):
+        return str(o.__html__())
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+class OrjsonProvider(JSONProvider):
+    """JSON provider backed by orjson for jsonify() and request.get_json()."""
+
+    # datetimes are encoded natively as RFC 3339 (the API's date-time
+    # format); pymongo hands back naive UTC, hence OPT_NAIVE_UTC
+    option = orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_orjson_default, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=_orjson_default, option=self.option),
+            mimetype="application/json"
+        )
+
+
+def json_array_stream(items):
+    """
+    Encode an iterable as a JSON array piece by piece, for a streamed
+    Response, so the whole list never sits in memory at once.
+    """
+    yield b"["
+    first = True
+    for item in items:
+        chunk = orjson.dumps(item, default=_orjson_default, option=OrjsonProvider.option)
+        yield chunk if first else b"," + chunk
+        first = False
+    yield b"]"
+
+
+def json_body():
+    """
+    Parse the request body straight from bytes with orjson.
+    Empty or non-object bodies give {}; malformed JSON raises
+    orjson.JSONDecodeError (answered with 400 by the app).
+    """
+    if not request.content_length:
+        return {}
+    data = orjson.loads(request.get_data(cache=False))
+    return data if isinstance(data, dict) else {}
@@ -1,6 +1,64 @@
+import re
+from bson import ObjectId
 from pymongo import MongoClient
+from pymongo.errors import OperationFailure
 from config import Config
 
 
-client = MongoClient(Config.MONGO_URI)
-db = client.get_database()
\ No newline at end of file
+client = MongoClient(Config.MONGO_URI, compressors=Config.MONGO_COMPRESSORS)
+db = client.get_database()
+
+_OID_RE = re.compile(r'[0-9a-fA-F]{24}')
+
+
+def parse_object_id(value):
+    """
+    ObjectId for a 24-hex-char string, else None.
+    Rejects bad input without raising/catching bson's InvalidId.
+    """
+    if isinstance(value, str) and _OID_RE.fullmatch(value):
+        return ObjectId(value)
+    return None
+
+
+def chat_id_match(chat_oid):
+    """
+    Filter value for messages.chat_id matching both the ObjectId form and the
+    legacy string form. Needed until `flask migrate-chat-ids` has run
+    everywhere; then this can become plain chat_oid.
+    """
+    return {"$in": [chat_oid, str(chat_oid)]}
+
+
+def migrate_message_chat_ids():
+    """
+    One-off (`flask migrate-chat-ids`): convert messages.chat_id stored as
+    24-hex strings (the old format) to ObjectId, server-side. Anything that
+    isn't a valid id is left as it was instead of failing the update.
+    """
+    return db.messages.update_many(
+        {"chat_id": {"$type": "string"}},
+        [{"$set": {"chat_id": {"$convert": {
+            "input": "$chat_id", "to": "objectId",
+            "onError": "$chat_id", "onNull": "$chat_id"
+        }}}}]
+    ).modified_count
+
+
+def ensure_indexes():
+    """Create the indexes the model queries rely on (idempotent; run at startup)."""
+    # get_user_chats: filter by owner, newest first. Carries every field the
+    # listing projects, so it is answered from the index alone. Supersedes
+    # the earlier (user_id, updated_at) index, which is a prefix of it.
+    db.chats.create_index([
+        ("user_id", 1), ("updated_at", -1), ("_id", 1), ("title", 1), ("created_at", 1)
+    ])
+    try:
+        db.chats.drop_index("user_id_1_updated_at_-1")
+    except OperationFailure:  # already dropped
+        pass
+    # iter_messages / history rebuild: one chat's messages in order
+    db.messages.create_index([("chat_id", 1), ("created_at", 1)])
+    # Uniqueness is enforced here; models.users maps DuplicateKeyError to ValueError
+    db.users.create_index("username", unique=True)
+    db.users.create_index("email", unique=True)
@@ -1,8 +1,7 @@
 # models/chat.py
-from bson import ObjectId
-from datetime import datetime
 from typing import Optional, List, Dict, Any
-from . import db
+from extensions import utc_now
+from . import db, parse_object_id, chat_id_match
 
 # Collections
 chats = db.chats
@@ -12,11 +11,13 @@ messages = db.messages
 # CREATE CHAT
 # ----------------------------------------------------------------------
 def create_chat(user_id: str, title: str = "New Chat") -> Dict[str, Any]:
+    now = utc_now()
     doc = {
         "user_id": user_id,
         "title": title.strip(),
-        "created_at": datetime.utcnow(),
-        "updated_at": datetime.utcnow(),
+        "created_at": now,
+        "updated_at": now,
+        "message_count": 0,  # bumped by add_message; 0 means no turns yet
     }
     result = chats.insert_one(doc)
     doc["_id"] = str(result.inserted_id)
@@ -26,38 +27,29 @@ def create_chat(user_id: str, title: str = "New Chat") -> Dict[str, Any]:
 # LIST USER CHATS
 # ----------------------------------------------------------------------
 def get_user_chats(user_id: str) -> List[Dict[str, Any]]:
-    cursor = chats.find({"user_id": user_id}).sort("updated_at", -1)
-    result = []
-
-    for c in cursor:
-        c["_id"] = str(c["_id"])
-        c["created_at"] = c["created_at"].isoformat()
-
-        # Safe updated_at
-        if "updated_at" not in c or c["updated_at"] is None:
-            updated_at = c["created_at"]
-        else:
-            updated_at = c["updated_at"]
-
-        c["updated_at"] = (
-            updated_at.isoformat()
-            if isinstance(updated_at, datetime)
-            else updated_at
-        )
-        result.append(c)
-
-    return result
+    # Shaped server-side: string ids and ISO-8601 UTC dates
+    # ($dateToString's default "%Y-%m-%dT%H:%M:%S.%LZ")
+    return list(chats.aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$sort": {"updated_at": -1}},
+        {"$project": {
+            "_id": {"$toString": "$_id"},
+            "title": 1,
+            "created_at": {"$dateToString": {"date": "$created_at"}},
+            # create_chat always sets updated_at; fall back only for very old docs
+            "updated_at": {"$dateToString": {"date": {"$ifNull": ["$updated_at", "$created_at"]}}},
+        }},
+    ]))
 
 # ----------------------------------------------------------------------
 # GET SINGLE CHAT
 # ----------------------------------------------------------------------
 def get_chat(chat_id: str, user_id: str) -> Optional[Dict[str, Any]]:
-    try:
-        chat_oid = ObjectId(chat_id)
-    except Exception:
+    chat_oid = parse_object_id(chat_id)
+    if chat_oid is None:
         return None
 
-    doc = chats.find_one({"_id": chat_oid, "user_id": user_id})
+    doc = chats.find_one({"_id": chat_oid, "user_id": user_id}, {"history": 0})
     if not doc:
         return None
 
@@ -72,35 +64,30 @@ def get_chat(chat_id: str, user_id: str) -> Optional[Dict[str, Any]]:
     return doc
 
 # ----------------------------------------------------------------------
-# DELETE CHAT + CASCADE
+# DELETE CHAT (messages are cascaded by models.message.delete_messages)
 # ----------------------------------------------------------------------
 def delete_chat(chat_id: str, user_id: str) -> bool:
-    try:
-        chat_oid = ObjectId(chat_id)
-    except Exception:
+    chat_oid = parse_object_id(chat_id)
+    if chat_oid is None:
         return False
 
     result = chats.delete_one({"_id": chat_oid, "user_id": user_id})
-    if result.deleted_count == 0:
-        return False
-
-    messages.delete_many({"chat_id": chat_oid})
-    return True
+    return result.deleted_count > 0
 
 # ----------------------------------------------------------------------
 # UPDATE CHAT TITLE
 # ----------------------------------------------------------------------
-def update_chat_title(chat_id: str, new_title: str) -> bool:
-    try:
-        chat_oid = ObjectId(chat_id)
-    except Exception:
+def update_chat_title(chat_id: str, user_id: str, new_title: str) -> bool:
+    chat_oid = parse_object_id(chat_id)
+    if chat_oid is None:
         return False
 
+    # Ownership is part of the filter: no match means missing or not owned
     result = chats.update_one(
-        {"_id": chat_oid},
-        {"$set": {"title": new_title.strip(), "updated_at": datetime.utcnow()}}
+        {"_id": chat_oid, "user_id": user_id},
+        {"$set": {"title": new_title.strip(), "updated_at": utc_now()}}
     )
-    return result.modified_count > 0
+    return result.matched_count > 0
 
 # ----------------------------------------------------------------------
 # EDIT USER MESSAGE
@@ -112,20 +99,9 @@ def update_message_role_content(
     role: Optional[str] = None,
     content: Optional[str] = None,
 ) -> bool:
-    try:
-        msg_oid = ObjectId(message_id)
-        chat_oid = ObjectId(chat_id)
-    except Exception:
-        return False
-
-    msg = messages.find_one(
-        {"_id": msg_oid, "chat_id": chat_oid, "role": "user"}
-    )
-    if not msg:
-        return False
-
-    chat = chats.find_one({"_id": chat_oid, "user_id": user_id})
-    if not chat:
+    msg_oid = parse_object_id(message_id)
+    chat_oid = parse_object_id(chat_id)
+    if msg_oid is None or chat_oid is None:
         return False
 
     update_fields = {}
@@ -137,8 +113,28 @@ def update_message_role_content(
     if not update_fields:
         return True
 
+    # Ownership, chat and role constraints all live in the one filter
     result = messages.update_one(
-        {"_id": msg_oid},
+        {"_id": msg_oid, "chat_id": chat_id_match(chat_oid), "role": "user", "user_id": user_id},
         {"$set": update_fields}
     )
-    return result.modified_count > 0
\ No newline at end of file
+
+    if result.matched_count == 0:
+        # Messages stored before user_id was denormalized: verify the chat
+        # owner the old way and backfill user_id while updating
+        if not chats.find_one({"_id": chat_oid, "user_id": user_id}, {"_id": 1}):
+            return False
+        result = messages.update_one(
+            {"_id": msg_oid, "chat_id": chat_id_match(chat_oid), "role": "user", "user_id": {"$exists": False}},
+            {"$set": {**update_fields, "user_id": user_id}}
+        )
+        if result.matched_count == 0:
+            return False
+
+    # Keep the embedded history on the chat in step with the message
+    chats.update_one(
+        {"_id": chat_oid},
+        {"$set": {f"history.$[m].{k}": v for k, v in update_fields.items()}},
+        array_filters=[{"m.id": msg_oid}]
+    )
+    return True
\ No newline at end of file
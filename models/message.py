@@ -1,40 +1,113 @@
 # models/message.py
-from datetime import datetime
-from . import db
+from datetime import datetime, timezone
+from . import db, parse_object_id, chat_id_match
 
 messages = db.messages
+chats = db.chats
+
+# Most recent turns mirrored onto the chat document ({"id", "role", "content"}),
+# so get_history is a single find_one instead of a sorted scan of messages
+HISTORY_LIMIT = 50
+
+# Full-chat reads: only the fields the API returns, shaped server-side
+# (string id, ISO-8601 UTC date), in large batches; sorted by the
+# (chat_id, created_at) index, no in-memory sort
+MESSAGE_SHAPE = {
+    "_id": 0,
+    "id": {"$toString": "$_id"},
+    "role": 1,
+    "content": 1,
+    "sources": {"$ifNull": ["$sources", []]},
+    "created_at": {"$dateToString": {"date": "$created_at"}},
+}
+MESSAGES_BATCH = 200
+
+def add_message(chat_id: str, user_id: str, role: str, content: str, sources: list = None):
+    """Store one turn and mirror it onto the chat; None for a malformed chat_id."""
+    chat_oid = parse_object_id(chat_id)
+    if chat_oid is None:
+        return None
 
-def add_message(chat_id: str, role: str, content: str, sources: list = None):
     doc = {
-        "chat_id": chat_id,
+        "chat_id": chat_oid,
+        "user_id": user_id,  # denormalized chat owner, so edits need no chat lookup
         "role": role,
         "content": content,
         "sources": sources or [],
-        "created_at": datetime.utcnow()
+        # Fresh clock, not the per-request stamp: messages written in the
+        # same request must still sort in the order they were added
+        "created_at": datetime.now(timezone.utc)
     }
     result = messages.insert_one(doc)
+    chats.update_one(
+        {"_id": chat_oid},
+        {
+            "$push": {"history": {
+                "$each": [{"id": result.inserted_id, "role": role, "content": content}],
+                "$slice": -HISTORY_LIMIT
+            }},
+            "$inc": {"message_count": 1}
+        }
+    )
     doc["_id"] = str(result.inserted_id)
     return doc
 
-def get_history(chat_id: str):
-    cursor = messages.find({"chat_id": chat_id}).sort("created_at", 1)
-    return [{"role": m["role"], "content": m["content"]} for m in cursor]
+def get_history(chat_id: str, user_id: str):
+    """
+    (recent turns, total message count) of the chat, or None if it doesn't
+    exist or isn't the user's.
+    """
+    chat_oid = parse_object_id(chat_id)
+    if chat_oid is None:
+        return None
+
+    chat = chats.find_one({"_id": chat_oid, "user_id": user_id}, {"history": 1, "message_count": 1})
+    if not chat:
+        return None
+    if "history" in chat:
+        history = [{"role": m["role"], "content": m["content"]} for m in chat["history"]]
+        # Chats from before message_count: the (capped) history is only ever empty for new chats
+        return history, chat.get("message_count", len(history))
 
-def get_messages(chat_id: str):
-    cursor = messages.find({"chat_id": chat_id}).sort("created_at", 1)
-    return [{
-        "id": str(m["_id"]),
-        "role": m["role"],
-        "content": m["content"],
-        "sources": m.get("sources", []),
-        "created_at": m["created_at"].isoformat()
-    } for m in cursor]
+    # Chat predates the embedded history: rebuild it from messages once
+    cursor = (messages.find({"chat_id": chat_id_match(chat_oid)}, {"role": 1, "content": 1})
+              .sort("created_at", 1).batch_size(MESSAGES_BATCH))
+    turns = [{"id": m["_id"], "role": m["role"], "content": m["content"]} for m in cursor]
+    recent = turns[-HISTORY_LIMIT:]
+    chats.update_one(
+        {"_id": chat_oid, "history": {"$exists": False}},
+        {"$set": {"history": recent, "message_count": len(turns)}}
+    )
+    return [{"role": m["role"], "content": m["content"]} for m in recent], len(turns)
+
+def iter_messages(chat_id: str):
+    """Yield the chat's messages in order, one cursor batch in memory at a time."""
+    chat_oid = parse_object_id(chat_id)
+    if chat_oid is None:
+        return
+    yield from messages.aggregate([
+        {"$match": {"chat_id": chat_id_match(chat_oid)}},
+        {"$sort": {"created_at": 1}},
+        {"$project": MESSAGE_SHAPE},
+    ], batchSize=MESSAGES_BATCH)
+
+def delete_messages(chat_id: str) -> int:
+    """Cascade for a deleted chat; safe to run out-of-band since the chat is gone."""
+    chat_oid = parse_object_id(chat_id)
+    if chat_oid is None:
+        return 0
+    return messages.delete_many({"chat_id": chat_id_match(chat_oid)}).deleted_count
+
+def set_message_sources(message_id: str, sources: list) -> bool:
+    """Attach sources found after the message was stored."""
+    msg_oid = parse_object_id(message_id)
+    if msg_oid is None:
+        return False
+    return messages.update_one({"_id": msg_oid}, {"$set": {"sources": sources}}).modified_count > 0
 
 def update_message_content(message_id: str, content: str, sources: list = None):
-    try:
-        from bson import ObjectId
-        msg_oid = ObjectId(message_id)
-    except Exception:
+    msg_oid = parse_object_id(message_id)
+    if msg_oid is None:
         return False
     
     update_data = {"content": content}
@@ -45,4 +118,8 @@ def update_message_content(message_id: str, content: str, sources: list = None):
         {"_id": msg_oid},
         {"$set": update_data}
     )
-    return result.modified_count > 0
\ No newline at end of file
+    chats.update_one(
+        {"history.id": msg_oid},
+        {"$set": {"history.$.content": content}}
+    )
+    return result.modified_count > 0
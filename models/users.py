@@ -1,24 +1,102 @@
 # models/users.py
+import base64
 import bcrypt
-from datetime import datetime
+import hashlib
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from threading import Lock, RLock
 from typing import Optional, Dict, Any
 from bson import ObjectId
-from . import db
+from cachetools import TTLCache
+from pymongo.errors import DuplicateKeyError
+from config import Config
+from extensions import utc_now
+from . import db, parse_object_id
 
 users = db.users
 
+# Recently verified (stored hash, password) pairs, so repeated logins skip
+# bcrypt. Keys are HMACs under a per-process secret; only successes are
+# cached, and a password change alters the stored hash, which retires them.
+_verified = TTLCache(maxsize=4096, ttl=30)
+_verified_lock = Lock()
+_VERIFY_KEY = os.urandom(32)
+
+# User documents by lookup key (("_id", id), ("username", name), ...), plus
+# the keys cached per user so a mutation can drop all of them. Only hits
+# are cached; anything that writes a user doc must call invalidate_user.
+_user_cache = TTLCache(maxsize=10000, ttl=60)
+_user_cache_keys = TTLCache(maxsize=10000, ttl=60)
+_user_cache_lock = RLock()
+
+# bcrypt salt = fixed "$2b$<cost>$" prefix + 16 random bytes in bcrypt's
+# base64 alphabet (22 chars); built directly instead of via bcrypt.gensalt
+_SALT_PREFIX = b"$2b$%02d$" % Config.BCRYPT_COST
+_BCRYPT_B64 = bytes.maketrans(
+    b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/",
+    b"./ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
+)
+
+# All bcrypt work runs here. bcrypt releases the GIL, so this runs on
+# every core, while capping concurrent hashes at one per core: a login
+# burst can't oversubscribe the CPU the streaming threads need.
+_BCRYPT_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
+# Stored as users.password_scheme. Hashes without it are legacy: bcrypt
+# over the raw password (silently truncated at 72 bytes).
+PASSWORD_SCHEME = "bcrypt-sha256"
+
+
+def _bcrypt_input(pw: str, scheme: Optional[str]) -> bytes:
+    """SHA-256 hex pre-hash for PASSWORD_SCHEME: fixed 64 bytes, under bcrypt's limit."""
+    if scheme == PASSWORD_SCHEME:
+        return hashlib.sha256(pw.encode("utf-8")).hexdigest().encode("ascii")
+    return pw.encode("utf-8")
+
 
 def hash_password(pw: str) -> bytes:
     """
-    Hash a password using bcrypt.
+    Hash a password using bcrypt over its SHA-256 (PASSWORD_SCHEME).
     Returns bytes, which MongoDB stores as Binary.
     """
-    return bcrypt.hashpw(pw.encode("utf-8"), bcrypt.gensalt(rounds=12))
+    salt = _SALT_PREFIX + base64.b64encode(os.urandom(16)).translate(_BCRYPT_B64)[:22]
+    return _BCRYPT_POOL.submit(bcrypt.hashpw, _bcrypt_input(pw, PASSWORD_SCHEME), salt).result()
+
+
+def check_password(stored_hash: bytes, provided_pw: str, scheme: Optional[str] = None) -> bool:
+    """Verify a password against a stored bcrypt hash (scheme=None for legacy hashes)."""
+    stored_hash = bytes(stored_hash)  # Mongo returns Binary
+    pw = _bcrypt_input(provided_pw, scheme)
+    key = hmac.new(_VERIFY_KEY, stored_hash + b"\0" + pw, hashlib.sha256).digest()
+    with _verified_lock:
+        if key in _verified:
+            return True
+
+    # Re-hash with the stored salt/cost and compare in constant time
+    candidate = _BCRYPT_POOL.submit(bcrypt.hashpw, pw, stored_hash).result()
+    ok = hmac.compare_digest(candidate, stored_hash)
+    if ok:
+        with _verified_lock:
+            _verified[key] = True
+    return ok
+
+
+@lru_cache(maxsize=1024)
+def _user_oid(user_id: str) -> Optional[ObjectId]:
+    """
+    parse_object_id for user ids, memoized: the same few ids (from JWTs)
+    repeat across requests. None for malformed ids, which match no user.
+    """
+    return parse_object_id(user_id)
 
 
-def check_password(stored_hash: bytes, provided_pw: str) -> bool:
-    """Verify a password against a stored bcrypt hash."""
-    return bcrypt.checkpw(provided_pw.encode("utf-8"), stored_hash)
+def _duplicate_error(e: DuplicateKeyError) -> ValueError:
+    """Translate a unique-index violation into the model's ValueError messages."""
+    if "username" in ((e.details or {}).get("keyPattern") or {}):
+        return ValueError("Username already taken")
+    return ValueError("Email already in use")
 
 
 def _convert_id(doc: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
@@ -30,67 +108,108 @@ def _convert_id(doc: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
 
 def create_user(username: str, email: str, password: str) -> Dict[str, Any]:
     """Create a new user with hashed password and timestamps."""
-    if users.find_one({"$or": [{"username": username}, {"email": email}]}):
-        raise ValueError("Username or email already exists")
-
+    now = utc_now()
     user_doc = {
         "username": username,
         "email": email,
         "password_hash": hash_password(password),
+        "password_scheme": PASSWORD_SCHEME,
         "avatar_url": None,  # optional
-        "created_at": datetime.utcnow(),
-        "updated_at": datetime.utcnow(),
+        "token_version": 0,  # bumped on logout to revoke issued JWTs
+        "created_at": now,
+        "updated_at": now,
     }
-    result = users.insert_one(user_doc)
+    # Unique indexes on username/email reject duplicates (no check-then-insert race)
+    try:
+        result = users.insert_one(user_doc)
+    except DuplicateKeyError as e:
+        raise _duplicate_error(e) from None
     user_doc["_id"] = str(result.inserted_id)
     return user_doc
 
 
+# Lookups return only these (plus _id), never credentials or token_version;
+# only the login checks fetch the hash
+USER_PUBLIC_FIELDS = {"username": 1, "email": 1, "avatar_url": 1, "created_at": 1, "updated_at": 1}
+USER_LOGIN_FIELDS = {"_id": 1, "password_hash": 1, "password_scheme": 1, "token_version": 1}
+
+
+def _cached_user(key: tuple, query: Dict[str, Any],
+                 projection: Dict[str, Any] = USER_PUBLIC_FIELDS) -> Optional[Dict[str, Any]]:
+    """find_one through _user_cache; callers get their own copy of the doc."""
+    with _user_cache_lock:
+        doc = _user_cache.get(key)
+    if doc is None:
+        doc = _convert_id(users.find_one(query, projection))
+        if not doc:
+            return None
+        with _user_cache_lock:
+            _user_cache[key] = doc
+            _user_cache_keys[doc["_id"]] = _user_cache_keys.get(doc["_id"], frozenset()) | {key}
+    return dict(doc)
+
+
+def invalidate_user(user_id: str) -> None:
+    """Drop every cached lookup of this user (call after any write to the doc)."""
+    with _user_cache_lock:
+        for key in _user_cache_keys.pop(user_id, ()):
+            _user_cache.pop(key, None)
+
+
 def get_user_by_id(user_id: str) -> Optional[Dict[str, Any]]:
     """Retrieve user by string _id."""
-    try:
-        doc = users.find_one({"_id": ObjectId(user_id)})
-        return _convert_id(doc)
-    except Exception:
+    user_oid = _user_oid(user_id)
+    if user_oid is None:
         return None
+    return _cached_user(("_id", user_id), {"_id": user_oid})
 
 
 def get_user_by_username(username: str) -> Optional[Dict[str, Any]]:
     """Retrieve user by username."""
-    doc = users.find_one({"username": username})
-    return _convert_id(doc)
+    return _cached_user(("username", username), {"username": username})
 
 
 def get_user_by_email(email: str) -> Optional[Dict[str, Any]]:
     """Retrieve user by email."""
-    doc = users.find_one({"email": email})
-    return _convert_id(doc)
+    return _cached_user(("email", email), {"email": email})
 
 
 def get_user_by_identifier(identifier: str) -> Optional[Dict[str, Any]]:
     """
     Find user by either username or email in a single query.
     """
-    doc = users.find_one(
+    return _cached_user(
+        ("identifier", identifier),
         {"$or": [{"username": identifier}, {"email": identifier}]}
     )
-    return _convert_id(doc)
 
 
 def verify_login(username: str, password: str) -> bool:
     """Legacy: verify by username only."""
-    user = get_user_by_username(username)
+    user = _cached_user(("login", "username", username), {"username": username}, USER_LOGIN_FIELDS)
     if not user:
         return False
-    return check_password(user["password_hash"], password)
+    return check_password(user["password_hash"], password, user.get("password_scheme"))
+
+
+def authenticate(identifier: str, password: str) -> Optional[Dict[str, Any]]:
+    """
+    Verify login using either username or email.
+    Returns {"_id", "token_version"} on success (one lookup), else None.
+    """
+    user = _cached_user(
+        ("login", "identifier", identifier),
+        {"$or": [{"username": identifier}, {"email": identifier}]},
+        USER_LOGIN_FIELDS
+    )
+    if not user or not check_password(user.pop("password_hash"), password, user.pop("password_scheme", None)):
+        return None
+    return user
 
 
 def verify_login_by_identifier(identifier: str, password: str) -> bool:
     """Verify login using either username or email."""
-    user = get_user_by_identifier(identifier)
-    if not user:
-        return False
-    return check_password(user["password_hash"], password)
+    return authenticate(identifier, password) is not None
 
 
 def update_profile(
@@ -103,27 +222,39 @@ def update_profile(
     Update user profile fields.
     Returns True if update was successful.
     """
-    update_fields = {"updated_at": datetime.utcnow()}
+    user_oid = _user_oid(user_id)
+    update_fields = {"updated_at": utc_now()}
     if username is not None:
-        if users.find_one({"username": username, "_id": {"$ne": ObjectId(user_id)}}):
-            raise ValueError("Username already taken")
         update_fields["username"] = username
-
     if email is not None:
-        if users.find_one({"email": email, "_id": {"$ne": ObjectId(user_id)}}):
-            raise ValueError("Email already in use")
         update_fields["email"] = email
 
+    # One uniqueness query for both fields; the returned doc says which clashed
+    clauses = [{k: update_fields[k]} for k in ("username", "email") if k in update_fields]
+    if clauses:
+        conflict = users.find_one(
+            {"$or": clauses, "_id": {"$ne": user_oid}},
+            {"username": 1, "email": 1}
+        )
+        if conflict:
+            if username is not None and conflict.get("username") == username:
+                raise ValueError("Username already taken")
+            raise ValueError("Email already in use")
+
     if avatar_url is not None:
         update_fields["avatar_url"] = avatar_url
 
     if len(update_fields) == 1:  # only updated_at
         return True
 
-    result = users.update_one(
-        {"_id": ObjectId(user_id)},
-        {"$set": update_fields}
-    )
+    try:
+        result = users.update_one(
+            {"_id": user_oid},
+            {"$set": update_fields}
+        )
+    except DuplicateKeyError as e:  # lost a race with another user claiming it
+        raise _duplicate_error(e) from None
+    invalidate_user(user_id)
     return result.modified_count > 0
 
 
@@ -134,9 +265,10 @@ def change_password(user_id: str, new_password: str) -> bool:
     """
     hashed = hash_password(new_password)
     result = users.update_one(
-        {"_id": ObjectId(user_id)},
-        {"$set": {"password_hash": hashed, "updated_at": datetime.utcnow()}}
+        {"_id": _user_oid(user_id)},
+        {"$set": {"password_hash": hashed, "password_scheme": PASSWORD_SCHEME, "updated_at": utc_now()}}
     )
+    invalidate_user(user_id)
     return result.modified_count > 0
 
 
@@ -146,9 +278,10 @@ def set_avatar_url(user_id: str, avatar_url: Optional[str]) -> bool:
     Pass None to remove.
     """
     result = users.update_one(
-        {"_id": ObjectId(user_id)},
-        {"$set": {"avatar_url": avatar_url, "updated_at": datetime.utcnow()}}
+        {"_id": _user_oid(user_id)},
+        {"$set": {"avatar_url": avatar_url, "updated_at": utc_now()}}
     )
+    invalidate_user(user_id)
     return result.modified_count > 0
 
 